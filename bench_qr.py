@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+'''
+Compare decoding of full uri qr codes with the short ids of 'qren.py --short'
+Renders every uri in the registry both ways, then degrades the image the way
+the player sees it: the code is scaled down to a given width inside a
+300x250 frame (zbarcam --prescale=300x250), blurred and given sensor noise.
+Reports the decode success rate and latency per width, smaller widths are
+like holding the card further from the camera.
+Uses the qrencode and zbarimg commands like the player does; where those are
+missing it falls back to the qrcode and zxing-cpp python packages. Needs Pillow.
+'''
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from PIL import Image, ImageChops, ImageFilter
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+sh = logging.StreamHandler()
+sh.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)-8s: %(message)s'))
+logger.addHandler(sh)
+
+FRAME = (300, 250)
+
+samples = {
+    'id:0': 'lib:track:/FLAC/Queen/A Night At The Opera/09 Love Of My Life.flac',
+    'id:1': 'lib:album:/MP3/Ane Brun/Rarities/',
+    'id:2': 'spotify:album:5fMVDfMZhrfT8oiUWR1Rz0',
+    'id:3': 'lib:track:/MP3/Ane Brun/Rarities/Ane Brun - 01. All My Tears.mp3',
+    'id:4': 'vol:music-library/USB/FLAC/Queen/A Night At The Opera/11 Bohemian Rhapsody.flac',
+    'id:5': 'cmd:toggle',
+}
+
+
+def render(payload):
+    ''' the qr code as qren makes it, one pixel per module '''
+    if shutil.which('qrencode'):
+        png = subprocess.check_output(['qrencode', '-o', '-', '-s', '1', payload])
+        return Image.open(io.BytesIO(png)).convert('L')
+    import qrcode
+    code = qrcode.QRCode(box_size=1, border=4)
+    code.add_data(payload)
+    return code.make_image().get_image().convert('L')
+
+
+def degrade(qr, width, blur, noise):
+    ''' scale the code to width pixels in a camera frame, blur it and add noise '''
+    frame = Image.new('L', FRAME, 160)
+    small = qr.resize((width, width), Image.BILINEAR)
+    frame.paste(small, ((FRAME[0] - width) // 2, (FRAME[1] - width) // 2))
+    if blur:
+        frame = frame.filter(ImageFilter.GaussianBlur(blur))
+    if noise:
+        frame = ImageChops.add(frame, Image.effect_noise(FRAME, noise), offset=-128)
+    return frame
+
+
+def decode(image, path):
+    ''' returns (decoded text or None, seconds) '''
+    if shutil.which('zbarimg'):
+        png = os.path.join(path, 'frame.png')
+        image.save(png)
+        start = time.perf_counter()
+        result = subprocess.run(['zbarimg', '-q', '--raw', png], stdout=subprocess.PIPE)
+        return result.stdout.decode().rstrip('\n') or None, time.perf_counter() - start
+    import zxingcpp
+    start = time.perf_counter()
+    results = zxingcpp.read_barcodes(image)
+    return (results[0].text if results else None), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare decoding of full uri and short id qr codes')
+    parser.add_argument('-r', '--registry', type=str, default='registry.json', help='registry to take the uris from (default: registry.json, falls back to a few samples)')
+    parser.add_argument('--widths', type=str, default='150,110,80,60,45,35', help='widths in pixels of the code in the 300x250 frame (default: 150,110,80,60,45,35)')
+    parser.add_argument('--blur', type=float, default=0.8, help='gaussian blur radius in pixels (default: 0.8)')
+    parser.add_argument('--noise', type=float, default=12, help='standard deviation of the pixel noise (default: 12)')
+    parser.add_argument('--trials', type=int, default=5, help='noisy frames per uri and width (default: 5)')
+    args = parser.parse_args()
+
+    registry = samples
+    if os.path.exists(args.registry):
+        with open(args.registry, 'r') as f:
+            registry = json.load(f)
+    logger.info('comparing {} uris, encoding with {}, decoding with {}'.format(
+        len(registry), 'qrencode' if shutil.which('qrencode') else 'qrcode',
+        'zbarimg' if shutil.which('zbarimg') else 'zxing-cpp'))
+
+    codes = {coding: [(payload, render(payload)) for payload in
+                      (registry.values() if coding == 'full' else registry.keys())]
+             for coding in ('full', 'short')}
+    for coding, rendered in codes.items():
+        logger.info('{} codes are {} to {} modules wide'.format(
+            coding, min(qr.size[0] for _, qr in rendered), max(qr.size[0] for _, qr in rendered)))
+
+    row = '{:<6} {:>10} {:>8} {:>12}'
+    lines = [row.format('coding', 'width [px]', 'decoded', 'latency [ms]')]
+    with tempfile.TemporaryDirectory() as path:
+        for width in [int(w) for w in args.widths.split(',')]:
+            for coding, rendered in codes.items():
+                results = []
+                for payload, qr in rendered:
+                    for _ in range(args.trials):
+                        text, seconds = decode(degrade(qr, width, args.blur, args.noise), path)
+                        results.append((text == payload, seconds))
+                lines.append(row.format(coding, width,
+                                        '{:.0%}'.format(sum(ok for ok, _ in results) / len(results)),
+                                        '{:.2f}'.format(1000 * sum(s for _, s in results) / len(results))))
+    logger.info('results:\n' + '\n'.join(lines))
+
+
+if __name__ == '__main__':
+    main()
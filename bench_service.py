@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+'''
+Load benchmark for the qren card service ('qren.py --serve')
+Runs a CardService in process with make_card and generate_pdf replaced by
+stand-ins that only take some time, so neither the library, Spotify nor
+qrencode are needed, and submits thousands of jobs over http from several
+client threads. Reports submit throughput, rejected jobs and job latency.
+
+    python3 bench_service.py --jobs 5000 --clients 8 --workers 4
+'''
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import qren
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+sh = logging.StreamHandler()
+sh.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)-8s: %(message)s'))
+logger.addHandler(sh)
+
+
+class StandinUri:
+
+    def __init__(self, uri_in):
+        self.uri_in = uri_in
+        self.html_file = 'out/{}.html'.format(uri_in.split(':')[-1])
+        self.is_processed = False
+
+
+def standin_card(work):
+    def make_card(uri_in, registry=None, index=None, item=None, title=None):
+        time.sleep(work)
+        return StandinUri(uri_in)
+    return make_card
+
+
+def standin_pdf(work):
+    def generate_pdf(filename='print', cards=None):
+        time.sleep(work)
+    return generate_pdf
+
+
+def post(url, job):
+    request = urllib.request.Request(url, data=json.dumps(job).encode(), method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load benchmark for the qren card service')
+    parser.add_argument('--jobs', type=int, default=5000, help='number of jobs to submit (default: 5000)')
+    parser.add_argument('--clients', type=int, default=8, help='number of submitting threads (default: 8)')
+    parser.add_argument('--workers', type=int, default=4, help='number of service workers (default: 4)')
+    parser.add_argument('--queue', type=int, default=1000, help='queue size of the service (default: 1000)')
+    parser.add_argument('--work', type=float, default=0.002, help='seconds a card job takes (default: 0.002)')
+    parser.add_argument('--prints', type=float, default=0.01, help='fraction of print jobs (default: 0.01)')
+    parser.add_argument('--port', type=int, default=8799, help='port to serve on (default: 8799)')
+    args = parser.parse_args()
+
+    qren.logger.setLevel(logging.WARNING)
+    qren.make_card = standin_card(args.work)
+    qren.generate_pdf = standin_pdf(10 * args.work)
+
+    service = qren.CardService(port=args.port, workers=args.workers, queue_size=args.queue)
+    threading.Thread(target=service.serve, daemon=True).start()
+    time.sleep(0.5)
+    url = 'http://localhost:{}/jobs'.format(args.port)
+
+    codes = []
+    def client(count):
+        for _ in range(count):
+            if random.random() < args.prints:
+                job = {'type': 'print', 'filename': 'bench', 'priority': 1}
+            else:
+                job = {'uri': 'spotify:track:{:022d}'.format(random.randrange(10 ** 22)), 'priority': random.randrange(3)}
+            codes.append(post(url, job))
+
+    start = time.time()
+    clients = [threading.Thread(target=client, args=(args.jobs // args.clients,)) for _ in range(args.clients)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    submitted = time.time() - start
+
+    while any(job['status'] in ('queued', 'running') for job in list(service.jobs.values())):
+        time.sleep(0.05)
+    finished = time.time() - start
+
+    jobs = [job for job in list(service.jobs.values()) if 'finished' in job]
+    latencies = sorted(job['finished'] - job['submitted'] for job in jobs)
+    logger.info('submitted {} jobs in {:.2f} s ({:.0f} jobs/s), {} rejected with a full queue'.format(
+        len(codes), submitted, len(codes) / submitted, codes.count(503)))
+    logger.info('{} jobs done, {} failed, all finished after {:.2f} s'.format(
+        sum(1 for job in jobs if job['status'] == 'done'), sum(1 for job in jobs if job['status'] == 'failed'), finished))
+    logger.info('latency median {:.3f} s, 95% {:.3f} s, max {:.3f} s'.format(
+        percentile(latencies, 0.5), percentile(latencies, 0.95), percentile(latencies, 1)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,24 @@
 #!/usr/lib/python3
 import argparse
-import glob
+import collections
+import cProfile
+import functools
+import heapq
+import itertools
+import json
 import logging
+import math
 import os
+import queue
+import re
+import resource
+from bisect import bisect_left
+from contextlib import contextmanager
 from slugify import slugify
 import subprocess, shutil
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from bs4 import BeautifulSoup
 from mutagen.mp3 import MP3
@@ -12,6 +26,11 @@ from mutagen.flac import FLAC
 import pdfkit
 import spotipy
 import spotipy.util as sputil
+from socketIO_client import SocketIO
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
 
 # Initiate logging
 logger = logging.getLogger(__name__)
@@ -24,6 +43,150 @@ sh.setFormatter(fmt)
 sh.setLevel(logging.DEBUG)
 logger.addHandler(sh)
 
+REGISTRY_FILE = 'registry.json'
+INDEX_FILE = 'index.json'
+PROFILE_FILE = 'profile.json'
+
+class Profiler:
+    '''
+    Collects wall and cpu time and bytes read/written per stage of a card run (--profile)
+    cpu time includes finished child processes (qrencode, curl, wkhtmltopdf),
+    bytes are those read and written by qren itself, taken from /proc/self/io.
+    Both are process wide, so stages running in parallel threads are not told apart.
+    Optionally dumps a cProfile file per stage into dump_dir.
+    Stages should not be nested.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.dump_dir = None
+        self.card = None
+        self.count = 0
+        self.records = []
+        self.cards = {}
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        read, written = self._io()
+        wall, cpu = time.perf_counter(), self._cpu()
+        prof = cProfile.Profile() if self.dump_dir else None
+        if prof:
+            prof.enable()
+        try:
+            yield
+        finally:
+            if prof:
+                prof.disable()
+            end_read, end_written = self._io()
+            self._add({
+                'card': self.card,
+                'stage': name,
+                'wall': time.perf_counter() - wall,
+                'cpu': self._cpu() - cpu,
+                'read': end_read - read,
+                'written': end_written - written,
+            })
+            if prof:
+                dump = '{:04d}_{}_{}.prof'.format(self.count, slugify(str(self.card)), name)
+                prof.dump_stats(os.path.join(self.dump_dir, dump))
+
+    def _add(self, record):
+        self.count += 1
+        self.records.append(record)
+        for totals in (self.cards.setdefault(record['card'], {}), self.stages):
+            total = totals.setdefault(record['stage'], {'count': 0, 'wall': 0, 'cpu': 0, 'read': 0, 'written': 0})
+            total['count'] += 1
+            for key in ('wall', 'cpu', 'read', 'written'):
+                total[key] += record[key]
+
+    def report(self, filename=PROFILE_FILE):
+        '''
+        write per-card and aggregate totals to filename and log them as tables
+        the totals cover the whole run, the single records and the logged cards
+        only those since the last report, so long running modes can report per batch
+        '''
+        if not self.records:
+            return
+
+        with open(filename, 'w') as f:
+            json.dump({'stages': self.stages, 'cards': self.cards, 'records': self.records}, f, indent=1)
+        logger.info('wrote profile of {} stages to {}'.format(self.count, filename))
+
+        row = '{:<50.50} {:<10} {:>5} {:>9} {:>9} {:>10} {:>10}'
+        header = row.format('card', 'stage', 'count', 'wall [s]', 'cpu [s]', 'read [kB]', 'write [kB]')
+        lines = [header, '-' * len(header)]
+        cards = list(dict.fromkeys(record['card'] for record in self.records))
+        for card, totals in [(card, self.cards[card]) for card in cards] + [('total', self.stages)]:
+            for stage, total in totals.items():
+                lines.append(row.format(str(card), stage, total['count'],
+                                        '{:.3f}'.format(total['wall']), '{:.3f}'.format(total['cpu']),
+                                        total['read'] // 1024, total['written'] // 1024))
+        logger.info('profile:\n' + '\n'.join(lines))
+        self.records = []
+
+    @staticmethod
+    def _cpu():
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return time.process_time() + children.ru_utime + children.ru_stime
+
+    @staticmethod
+    def _io():
+        try:
+            with open('/proc/self/io', 'r') as f:
+                io = dict(line.split(': ') for line in f.read().splitlines())
+            return int(io['rchar']), int(io['wchar'])
+        except (OSError, KeyError, ValueError):
+            return 0, 0
+
+profiler = Profiler()
+
+def profiled(stage):
+    ''' decorator running the whole function as a profiler stage '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profiler.stage(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Artwork:
+    '''
+    Index of the artwork in img/ by card name, listed once instead of globbing
+    the folder for every lookup. Artwork written by qren is added as it is made.
+    '''
+
+    def __init__(self, path='img'):
+        self.path = path
+        self.files = None
+
+    def find(self, name):
+        if self.files is None:
+            # other threads only see the listing once it is complete
+            files = {}
+            for file in sorted(os.listdir(self.path)) if os.path.isdir(self.path) else []:
+                files.setdefault(os.path.splitext(file)[0], os.path.join(self.path, file))
+            self.files = files
+        return self.files.get(name)
+
+    def add(self, filename):
+        if self.files is not None:
+            file = os.path.basename(filename)
+            self.files[os.path.splitext(file)[0]] = os.path.join(self.path, file)
+
+artwork = Artwork()
+
+@functools.lru_cache(maxsize=1024)
+def read_tags(filetype, filename, mtime):
+    ''' tags of a music file, cached as long as the file is unchanged (same mtime) '''
+    return filetype(filename)
+
 class Music:
     '''
     A class containing all relevant information about a track or album
@@ -49,27 +212,286 @@ class Music:
     def art_uri(self):
         if self.name:
             # capture all img formats (e.g. png, jpg)
-            art_uri = 'img/{}.*'.format(self.name)
-            files = glob.glob(art_uri)
-            return files[0] if files else None
+            return artwork.find(self.name)
         else:
             return None
 
 
-class Uri:
+class Registry:
+    '''
+    Keeps track of short ids for output uri's, so the qr codes on the cards
+    can stay small. The registry file is a json dict of id -> uri and should
+    be copied next to qrplay.py on the player.
+    Ids are assigned once and never reused, so printed cards keep working.
+    New ids are kept in memory until save() is called at the end of a batch.
+    '''
+    prefix = 'id:'
+
+    def __init__(self, filename=REGISTRY_FILE):
+        self.filename = filename
+        self.ids = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self.ids = json.load(f)
+        self.uris = {uri: id for id, uri in self.ids.items()}
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def short_id(self, uri):
+        with self.lock:
+            if uri in self.uris:
+                return self.uris[uri]
+            id = self.prefix + self._base36(len(self.ids))
+            self.ids[id] = uri
+            self.uris[uri] = id
+            self.changed = True
+        logger.info('registered {} as {}'.format(uri, id))
+        return id
+
+    def save(self):
+        # write a temporary file first, a half written registry breaks every short card
+        with self.lock:
+            if not self.changed:
+                return
+            temp = self.filename + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(self.ids, f, indent=1)
+            os.replace(temp, self.filename)
+            self.changed = False
+        logger.info('saved {} short ids to {}'.format(len(self.ids), self.filename))
+
+    @staticmethod
+    def _base36(number):
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+        out = ''
+        while True:
+            number, rest = divmod(number, 36)
+            out = digits[rest] + out
+            if not number:
+                return out
+
+
+class Index:
+    '''
+    Inverted index (token -> uri's) over the music qren has processed, used by --find
+    The documents are keyed by uri_out and hold everything needed to
+    generate the card again. Updated after every processed uri, saved as json.
+    '''
 
-    def __init__(self, uri_in=None):
+    def __init__(self, filename=INDEX_FILE):
+        self.filename = filename
+        self.docs = {}
+        self.postings = {}
+        self._tokens = None
+        self.changed = False
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                data = json.load(f)
+            self.docs = data['docs']
+            self.postings = {token: set(uris) for token, uris in data['postings'].items()}
+            logger.info('loaded index with {} entries'.format(len(self.docs)))
+
+    @staticmethod
+    def tokenize(text):
+        return re.findall(r'\w+', text.lower()) if text else []
+
+    def add(self, uri):
+        ''' add (or update) a processed Uri instance '''
+        doc = {
+            'uri_in': uri.uri_in,
+            'uri_out': uri.uri_out,
+            'type': uri.type,
+            'artist': uri.music.artist,
+            'album': uri.music.album_title,
+            'title': uri.music.track_title,
+            'item': uri.item,
+        }
+        self.remove(uri.uri_out)
+        self.docs[uri.uri_out] = doc
+        for token in self._doc_tokens(doc):
+            self.postings.setdefault(token, set()).add(uri.uri_out)
+        self._tokens = None
+        self.changed = True
+
+    def remove(self, uri_out):
+        doc = self.docs.pop(uri_out, None)
+        if doc:
+            for token in self._doc_tokens(doc):
+                self.postings[token].discard(uri_out)
+                if not self.postings[token]:
+                    del self.postings[token]
+            self._tokens = None
+            self.changed = True
+
+    def search(self, query, limit=20):
+        '''
+        return the documents matching all words in query, best match first
+        words match on prefix ('oper' finds 'opera'), whole words and rare words weigh more
+        '''
+        words = set(self.tokenize(query))
+        if not words:
+            return []
+        matches = {}
+        for word in words:
+            matches[word] = set()
+            for token in self._expand(word):
+                matches[word] |= self.postings[token]
+        # intersect starting with the rarest word, keeps the candidate set small
+        order = sorted(words, key=lambda word: len(matches[word]))
+        candidates = matches[order[0]]
+        for word in order[1:]:
+            candidates = candidates & matches[word]
+        if not candidates:
+            return []
+
+        weights = []
+        for word in words:
+            idf = math.log(1 + len(self.docs) / len(matches[word]))
+            weights.append((self.postings.get(word, set()), idf))
+        scores = {uri: sum(idf * (2 if uri in exact else 1) for exact, idf in weights) for uri in candidates}
+        ranked = heapq.nsmallest(limit, scores, key=lambda uri: (-scores[uri], uri))
+        return [self.docs[uri] for uri in ranked]
+
+    def snapshot(self):
+        '''
+        a copy of the index to save, so writing it can happen while documents are added
+        documents are replaced rather than changed, copying the dicts is enough
+        '''
+        self.changed = False
+        return {'docs': dict(self.docs), 'postings': {token: list(uris) for token, uris in self.postings.items()}}
+
+    def save(self, snapshot=None):
+        data = self.snapshot() if snapshot is None else snapshot
+        for uris in data['postings'].values():
+            uris.sort()
+        temp = self.filename + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp, self.filename)
+        logger.info('saved index with {} entries to {}'.format(len(data['docs']), self.filename))
+
+    def _doc_tokens(self, doc):
+        tokens = set()
+        for field in ('artist', 'album', 'title', 'uri_in'):
+            tokens.update(self.tokenize(doc[field]))
+        return tokens
+
+    def _expand(self, word):
+        if self._tokens is None:
+            self._tokens = sorted(self.postings)
+        i = bisect_left(self._tokens, word)
+        while i < len(self._tokens) and self._tokens[i].startswith(word):
+            yield self._tokens[i]
+            i += 1
+
+
+class VolumioLibrary:
+    '''
+    Enumerates the library through Volumio's browse api over a single
+    socket.io session, instead of opening every file on the smb mount.
+    The uri's of the browsed items are the ones Volumio plays.
+    '''
+
+    def __init__(self, hostname='gijstereo.local', port=None, timeout=10, attempts=3):
+        self.hostname = hostname
+        self.port = port
+        self.timeout = timeout
+        self.attempts = attempts
+        self.response = None
+        self._connect()
+
+    def _connect(self):
+        self.sio = SocketIO(self.hostname, self.port)
+        self.sio.on('pushBrowseLibrary', self._on_browse)
+        logger.info('connected to {} for browsing'.format(self.hostname))
+
+    def _on_browse(self, data):
+        self.response = data
+
+    def browse(self, uri):
+        '''
+        return all items listed under uri
+        large sources return a 'next' uri in the navigation, which is followed
+        a page that gets no answer is asked again, up to 'attempts' times
+        '''
+        items = []
+        while uri:
+            navigation = self._browse_page(uri)
+            for lst in navigation.get('lists', []):
+                items += [self._absolute_art(item) for item in lst.get('items', [])]
+            uri = (navigation.get('next') or {}).get('uri')
+        return items
+
+    def _browse_page(self, uri):
+        for attempt in range(self.attempts):
+            self.response = None
+            self.sio.emit('browseLibrary', {'uri': uri})
+            start = time.time()
+            while self.response is None and time.time() - start < self.timeout:
+                self.sio.wait(seconds=0.1)
+            if self.response is not None:
+                return self.response.get('navigation', {})
+
+            # replies carry no request id, a late one would be taken for the
+            # next request, so ask again on a fresh session
+            logger.error('no browse response for {}, reconnecting'.format(uri))
+            self.sio.disconnect()
+            self._connect()
+        raise IOError('no browse response for {} after {} attempts'.format(uri, self.attempts))
+
+    def artists(self):
+        return [item for item in self.browse('artists://') if item.get('uri')]
+
+    def albums(self):
+        for artist in self.artists():
+            for album in self.browse(artist['uri']):
+                if album.get('type') == 'folder':
+                    album.setdefault('artist', artist.get('title'))
+                    yield album
+
+    def tracks(self):
+        for album in self.albums():
+            for track in self.browse(album['uri']):
+                if track.get('type') == 'song':
+                    track.setdefault('artist', album.get('artist'))
+                    track.setdefault('album', album.get('title'))
+                    yield track
+
+    def disconnect(self):
+        self.sio.disconnect()
+
+    def _absolute_art(self, item):
+        # albumart is usually served by volumio itself, e.g. '/albumart?path=...'
+        art = item.get('albumart')
+        if art and art.startswith('/'):
+            host = '{}:{}'.format(self.hostname, self.port) if self.port else self.hostname
+            item['albumart'] = 'http://{}{}'.format(host, art)
+        return item
+
+
+class Uri:
+    # the spotify session is shared by all instances, tokens last an hour
+    spotify_access = None
+    spotify_time = 0
+    spotify_token_age = 3000
+    spotify_metadata = collections.OrderedDict()
+    spotify_metadata_size = 1024
+    spotify_lock = threading.Lock()
+
+    def __init__(self, uri_in=None, registry=None, item=None):
         self.uri_in = uri_in
+        self.registry = registry
+        self.item = item
         self.path = os.getcwd()
         self.path_out = os.path.join(os.getcwd(), 'out')
         self.path_img = os.path.join(os.getcwd(), 'img')
         self.music = None
-        self.spotify_access = None
+        self.html_file = None
         self.is_processed = False
 
-        if not os.path.exists(self.path_out):
-            os.mkdir(self.path_out)
-            os.mkdir(os.path.join(self.path_out, 'img'))
+        # several service workers can get here at once
+        os.makedirs(os.path.join(self.path_out, 'img'), exist_ok=True)
+        if not os.path.exists(os.path.join(self.path_out, 'cards.css')):
             shutil.copyfile('cards.css', os.path.join(self.path_out, 'cards.css'))
 
         if not uri_in:
@@ -79,7 +501,9 @@ class Uri:
 
     @property
     def type(self):
-        if self.uri_in:
+        if self.item:
+            return 'volumio'
+        elif self.uri_in:
             if 'spotify' in self.uri_in:
                 return 'spotify'
             elif 'cmd' in self.uri_in:
@@ -90,6 +514,7 @@ class Uri:
             return 'unknown'
 
     def process(self, title=None):
+        profiler.card = self.uri_in
         if self.is_processed:
             logger.info('Reprocessing...')
 
@@ -102,6 +527,9 @@ class Uri:
         elif self.type == 'command':
             self.uri_out = ''
             self.is_processed = self._process_cmd(title)
+        elif self.type == 'volumio':
+            self.uri_out = 'vol:'
+            self.is_processed = self._process_volumio_item()
         else:
             logger.error('Cannot process uri {}, type unknown!'.format(self.uri_in))
 
@@ -128,9 +556,11 @@ class Uri:
         html_filename = '{0}.html'.format(self.music.name)
         html_file = os.path.join(self.path_out, html_filename)
 
-        with open(html_file, 'w') as f:
-            f.write(html)
+        with profiler.stage('html'):
+            with open(html_file, 'w') as f:
+                f.write(html)
 
+        self.html_file = html_file
         logger.info('Generated card: {}'.format(html_file))
 
     def _process_library_uri(self):
@@ -143,7 +573,7 @@ class Uri:
             if os.path.splitext(self.uri_in)[-1].lower() == '.mp3':
                 track.filetype = 'mp3'
                 self.uri_out += '/MP3{}'.format(self.uri_in.split('/MP3')[1])
-                mp = MP3(self.uri_in)
+                mp = self._load_tags(MP3, self.uri_in)
                 track.track_title = mp.get('TIT2').text[0]
                 track.album_title = mp.get('TALB').text[0]
                 track.artist = mp.get('TPE1').text[0]
@@ -158,7 +588,7 @@ class Uri:
             elif os.path.splitext(self.uri_in)[-1].lower() == '.flac':
                 track.filetype = 'flac'
                 self.uri_out += '/FLAC{}'.format(self.uri_in.split('/FLAC')[1])
-                fl = FLAC(self.uri_in)
+                fl = self._load_tags(FLAC, self.uri_in)
                 track.track_title = fl.get('title')[0]
                 track.album_title = fl.get('album')[0]
                 track.artist = fl.get('artist')[0]
@@ -183,7 +613,7 @@ class Uri:
                 tracks = self._list_files(self.uri_in, 'mp3')
                 if tracks:
                     album.filetype = 'mp3'
-                    mp = MP3(tracks[0])
+                    mp = self._load_tags(MP3, tracks[0])
                     album.album_title = mp.get('TALB').text[0]
                     album.artist = mp.get('TPE1').text[0]
                     self.music = album
@@ -198,7 +628,7 @@ class Uri:
                 tracks = self._list_files(self.uri_in, 'flac')
                 if tracks:
                     album.filetype = 'flac'
-                    fl = FLAC(tracks[0])
+                    fl = self._load_tags(FLAC, tracks[0])
                     album.album_title = fl.get('album')[0]
                     album.artist = fl.get('artist')[0]
                     self.music = album
@@ -221,15 +651,17 @@ class Uri:
         if this process has been ran before during the session,
         sp should already exist
         '''
-        if not self.spotify_access:
-            sp = self._get_spotify_access()
+        if not self.spotify_access or time.time() - self.spotify_time > self.spotify_token_age:
+            self._get_spotify_access()
+        sp = self.spotify_access
 
         if 'track' in self.uri_in:
             logger.info('Processing {} as a spotify track.'.format(self.uri_in))
             track = Music()
             track.filetype = 'spotify'
 
-            sp_track = sp.track(self.uri_in)
+            with profiler.stage('spotify'):
+                sp_track = self._spotify_lookup(sp.track)
             track.track_title = sp_track['name']
             track.artist = sp_track['artists'][0]['name']
             track.album_title = sp_track['album']['name']
@@ -242,7 +674,8 @@ class Uri:
             album = Music()
             album.filetype = 'spotify'
 
-            sp_album = sp.album(self.uri_in)
+            with profiler.stage('spotify'):
+                sp_album = self._spotify_lookup(sp.album)
             album.album_title = sp_album['name']
             album.artist = sp_album['artists'][0]['name']
             self.music = album
@@ -252,12 +685,39 @@ class Uri:
         else:
             logger.error('Could not recognise the type of Spotify uri')
 
-        artimg = os.path.join(self.path_img,'{}.jpg'.format(self.music.name))
-        if not os.path.exists(artimg):
-            logger.debug('fetching artwork for {} from spotify'.format(self.music.name))
-            subprocess.check_output(['curl', arturl, '-o', artimg])
+        return self._fetch_artwork(arturl)
+
+    def _spotify_lookup(self, lookup):
+        ''' spotify metadata for uri_in, the most recently used are kept for the session '''
+        with self.spotify_lock:
+            if self.uri_in in self.spotify_metadata:
+                self.spotify_metadata.move_to_end(self.uri_in)
+                return self.spotify_metadata[self.uri_in]
+        metadata = lookup(self.uri_in)
+        with self.spotify_lock:
+            self.spotify_metadata[self.uri_in] = metadata
+            if len(self.spotify_metadata) > self.spotify_metadata_size:
+                self.spotify_metadata.popitem(last=False)
+        return metadata
+
+    def _process_volumio_item(self):
+        '''
+        process an item from Volumio's browse api (see VolumioLibrary)
+        songs become tracks, folders are assumed albums
+        '''
+        logger.info('Processing {} as a volumio {}.'.format(self.uri_in, self.item.get('type')))
+        music = Music()
+        music.filetype = 'volumio'
+        if self.item.get('type') == 'song':
+            music.track_title = self.item.get('title')
+            music.album_title = self.item.get('album')
+        else:
+            music.album_title = self.item.get('title')
+        music.artist = self.item.get('artist')
+        self.music = music
+        self.uri_out += self.uri_in
 
-        return True
+        return self._fetch_artwork(self.item.get('albumart'))
 
     def _process_cmd(self, title):
         logger.info('Processing command {}.'.format(self.uri_in))
@@ -266,12 +726,19 @@ class Uri:
         self.music.track_title = title
         return True
 
+    @profiled('tags')
+    def _load_tags(self, filetype, filename):
+        return read_tags(filetype, filename, os.stat(filename).st_mtime)
+
+    @profiled('artwork')
     def _find_artwork(self, loaded_file):
 
         artimg = os.path.join(self.path_img,'{0}.jpg'.format(self.music.name))
 
         if os.path.exists(artimg):
             logger.info('artwork already present')
+            # it may have been put in img/ after the listing
+            artwork.add(artimg)
             return True
         else:
             # check if the mp3/flac file contains an image
@@ -290,6 +757,7 @@ class Uri:
                 logger.info('found artwork in track file')
                 with open(artimg,'wb') as f:
                     f.write(img.data)
+                artwork.add(artimg)
                 return True
             else:
                 logger.debug('no artwork present in track file')
@@ -302,16 +770,35 @@ class Uri:
                         if 'folder.jpg' in jpg.lower():
                             logger.info('using {} as artwork'.format(jpg))
                             shutil.copyfile(jpg, artimg)
+                            artwork.add(artimg)
                             return True
                     logger.info('using {} as artwork'.format(jpgs[0]))
                     shutil.copyfile(jpgs[0], artimg)
+                    artwork.add(artimg)
                     return True
                 else:
                     # no artwork present in folder either
                     logger.error('using dummy art for {}'.format(self.music.name))
                     shutil.copyfile('img/dummy.png', 'img/{0}.png'.format(self.music.name))
+                    artwork.add('img/{0}.png'.format(self.music.name))
                     return True
 
+    @profiled('artwork')
+    def _fetch_artwork(self, arturl):
+        artimg = os.path.join(self.path_img,'{}.jpg'.format(self.music.name))
+        if os.path.exists(artimg):
+            logger.info('artwork already present')
+            artwork.add(artimg)
+        elif arturl:
+            logger.debug('fetching artwork for {} from {}'.format(self.music.name, arturl))
+            subprocess.check_output(['curl', arturl, '-o', artimg])
+            artwork.add(artimg)
+        else:
+            logger.error('using dummy art for {}'.format(self.music.name))
+            shutil.copyfile('img/dummy.png', 'img/{0}.png'.format(self.music.name))
+            artwork.add('img/{0}.png'.format(self.music.name))
+        return True
+
     def _generate_card_imgs(self):
         qrout = os.path.join(self.path_out, 'img', '{}_qr.png'.format(self.music.name))
         artin = self.music.art_uri
@@ -320,7 +807,10 @@ class Uri:
         except Exception as e:
             logger.error('could not find art image {} (error {})'.format(artin, e))
 
-        subprocess.check_output(['qrencode', '-o', qrout, '-s', '8', self.uri_out])
+        # with a registry the card only carries a short id, qrplay resolves it
+        payload = self.registry.short_id(self.uri_out) if self.registry else self.uri_out
+        with profiler.stage('qrencode'):
+            subprocess.check_output(['qrencode', '-o', qrout, '-s', '8', payload])
         return True
 
     def _card_content_html(self):
@@ -342,6 +832,7 @@ class Uri:
         html += '  </div>\n'
         return html
 
+    @profiled('spotify')
     def _get_spotify_access(self):
         username = 'gbstraathof'
         scope = 'user-library-read'
@@ -352,8 +843,8 @@ class Uri:
                                              client_secret=client_secret,
                                              redirect_uri='http://localhost/')
         if token:
-            spotify_access = True
-            self.spotify_access = spotipy.Spotify(auth=token)
+            Uri.spotify_access = spotipy.Spotify(auth=token)
+            Uri.spotify_time = time.time()
             return self.spotify_access
         else:
             raise ValueError('Can\'t get Spotify token for ' + username)
@@ -368,11 +859,47 @@ class Uri:
     def is_track(self):
         return True if self.music.track_title else False
 
+def make_card(uri_in, registry=None, index=None, item=None, title=None):
+    ''' process uri_in and generate its card, adding it to the index if given '''
+    u = Uri(uri_in, registry=registry, item=item)
+    u.process(title=title)
+    u.generate_card()
+    if index is not None and u.is_processed:
+        index.add(u)
+    return u
+
+def find(index, query, pick=None, limit=20, registry=None):
+    '''
+    list the best matches for query in the index
+    pick is a comma separated list of hit numbers (or 'all') to generate cards for
+    '''
+    start = time.time()
+    hits = index.search(query, limit=limit)
+    logger.info('found {} matches for "{}" in {:.1f} ms'.format(len(hits), query, 1000 * (time.time() - start)))
+    for number, hit in enumerate(hits, 1):
+        name = hit['title'] or hit['album']
+        logger.info('{:3d}. {} - {} ({})'.format(number, hit['artist'], name, hit['uri_out']))
+
+    if pick:
+        if pick == 'all':
+            numbers = range(1, len(hits) + 1)
+        else:
+            try:
+                numbers = [int(n) for n in pick.split(',')]
+            except ValueError:
+                numbers = [0]
+            if not all(1 <= number <= len(hits) for number in numbers):
+                logger.error("can't pick {}, choose hit numbers from 1 to {}".format(pick, len(hits)))
+                return
+        for number in numbers:
+            hit = hits[number - 1]
+            make_card(hit['uri_in'], registry=registry, index=index, item=hit['item'], title=hit['title'])
+
 def list_files(path, with_ext=None):
     ''' return a list of all files with extension 'with_ext' '''
     return [os.path.join(path, file) for file in os.listdir(path) if file.lower().endswith(with_ext)]
 
-def generate_pdf(filename='print'):
+def generate_pdf(filename='print', cards=None):
     # Create the output directory
 
     path_out = os.path.join(os.getcwd(), 'out')
@@ -390,40 +917,470 @@ def generate_pdf(filename='print'):
 
 '''
 
-    cards = list_files(path_out, 'html')
+    if cards is None:
+        cards = list_files(path_out, 'html')
     # for file in os.listdir(path):
     #     if file.endswith(".html"):
     #         cards.append(os.path.join(path, file))
 
     logger.info('found {} individual cards to merge'.format(len(cards)))
 
-    for card in cards:
-        with open(card, 'r') as f:
-            soup = BeautifulSoup(f, 'html.parser')
-
-        div = soup.find('div', {'class':'card'})
+    profiler.card = 'print:{}'.format(filename)
+    with profiler.stage('merge'):
+        for card in cards:
+            with open(card, 'r') as f:
+                soup = BeautifulSoup(f, 'html.parser')
 
-        if div:
-            html += div.prettify()
-            html += '\n'
+            div = soup.find('div', {'class':'card'})
 
-            if index % 2 == 1:
-                html += '<br style="clear: both;"/>\n'
+            if div:
+                html += div.prettify()
                 html += '\n'
 
-            index += 1
+                if index % 2 == 1:
+                    html += '<br style="clear: both;"/>\n'
+                    html += '\n'
 
-    html += '\n'
-    html += '</body>\n'
-    html += '</html>\n'
+                index += 1
 
-    with open(html_file, 'w') as f:
-        f.write(html)
+        html += '\n'
+        html += '</body>\n'
+        html += '</html>\n'
+
+        with open(html_file, 'w') as f:
+            f.write(html)
 
     pdf_file = os.path.join(os.getcwd(), filename+'.pdf')
-    if pdfkit.from_file(html_file, pdf_file, options={'quiet':''}):
+    with profiler.stage('pdfkit'):
+        created = pdfkit.from_file(html_file, pdf_file, options={'quiet':''})
+    if created:
         logger.info('created {}'.format(pdf_file))
 
+class Watcher:
+    '''
+    Watches a library root and generates cards for new or changed album folders
+    and for spotify drop-files (*.uri, containing one spotify uri per line)
+    Uses inotify when inotify_simple is installed. Otherwise, or with poll=True, it
+    compares the mtimes of all folders every interval and only lists the folders
+    that changed. inotify does not see changes made on the server side of network
+    mounts (like the smb mount of the Volumio library), those are always polled.
+    Changes are handled once they have been quiet for 'settle' seconds, so an
+    album that is still being copied is not picked up half way.
+    '''
+    dropfile_ext = '.uri'
+
+    network_filesystems = ('cifs', 'smb3', 'smbfs', 'nfs', 'nfs4', 'fuse.sshfs')
+
+    def __init__(self, root, settle=10, interval=5, registry=None, index=None, print_name=None, poll=False):
+        self.root = os.path.abspath(root)
+        self.settle = settle
+        self.interval = interval
+        self.registry = registry
+        self.index = index
+        self.print_name = print_name
+        self.pending = {}
+        self.mtimes = {}
+        self.dropfiles = {}
+        self.sizes = {}
+        poll = poll or self._filesystem(self.root) in self.network_filesystems
+        self.inotify = INotify() if INotify and not poll else None
+        self.watches = {}
+        self._add_tree(self.root, initial=True)
+        logger.info('watching {} folders in {} using {}'.format(
+            len(self.mtimes), self.root, 'inotify' if self.inotify else 'mtime snapshots'))
+
+    def run(self):
+        try:
+            while True:
+                if self.inotify:
+                    self._read_events()
+                else:
+                    time.sleep(self.interval)
+                    self._diff_snapshot()
+                self._process_settled()
+        except KeyboardInterrupt:
+            logger.info('Stopping watcher...')
+
+    def _add_tree(self, top, initial=False):
+        for path, dirs, files in os.walk(top):
+            # folders and files can vanish while they are walked, those are skipped
+            try:
+                self.mtimes[path] = os.stat(path).st_mtime
+                if self.inotify:
+                    # MODIFY keeps resetting the settle time while a large file is copied
+                    mask = flags.CREATE | flags.MOVED_TO | flags.MODIFY | flags.CLOSE_WRITE | flags.DELETE
+                    self.watches[self.inotify.add_watch(path, mask)] = path
+            except OSError as e:
+                logger.warning('not watching {}: {}'.format(path, e))
+                self.mtimes.pop(path, None)
+                dirs[:] = []
+                continue
+            for file in files:
+                if file.endswith(self.dropfile_ext):
+                    dropfile = os.path.join(path, file)
+                    try:
+                        self.dropfiles[dropfile] = os.stat(dropfile).st_mtime
+                    except OSError:
+                        continue
+                    if not initial:
+                        self._touch(dropfile)
+            if not initial:
+                self._touch(path)
+
+    @staticmethod
+    def _filesystem(path):
+        ''' type of the filesystem path is on, from the longest matching mount point '''
+        fstype, longest = None, ''
+        try:
+            with open('/proc/mounts', 'r') as f:
+                for line in f:
+                    mount, fs = line.split()[1:3]
+                    mount = mount.replace('\\040', ' ')
+                    if (path == mount or path.startswith(mount.rstrip('/') + '/')) and len(mount) > len(longest):
+                        fstype, longest = fs, mount
+        except OSError:
+            pass
+        return fstype
+
+    def _touch(self, path):
+        self.pending[path] = time.time()
+
+    def _read_events(self):
+        for event in self.inotify.read(timeout=1000 * self.interval):
+            parent = self.watches.get(event.wd)
+            if not parent or not event.name:
+                continue
+            path = os.path.join(parent, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    self._add_tree(path)
+            elif event.name.endswith(self.dropfile_ext):
+                if not event.mask & flags.DELETE:
+                    self._touch(path)
+            else:
+                self._touch(parent)
+
+    def _diff_snapshot(self):
+        # files being copied grow without changing their folder's mtime,
+        # so pending folders are kept pending while their total size changes
+        for path in list(self.pending):
+            if os.path.isdir(path):
+                size = self._size(path)
+                if size is not None and self.sizes.get(path) != size:
+                    self.sizes[path] = size
+                    self._touch(path)
+
+        for dropfile, mtime in list(self.dropfiles.items()):
+            try:
+                if os.stat(dropfile).st_mtime != mtime:
+                    self.dropfiles[dropfile] = os.stat(dropfile).st_mtime
+                    self._touch(dropfile)
+            except OSError:
+                del self.dropfiles[dropfile]
+
+        for path, mtime in list(self.mtimes.items()):
+            try:
+                current = os.stat(path).st_mtime
+            except OSError:
+                del self.mtimes[path]
+                continue
+            if current == mtime:
+                continue
+            # only folders which changed themselves are listed
+            self.mtimes[path] = current
+            self._touch(path)
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir() and entry.path not in self.mtimes:
+                        self._add_tree(entry.path)
+                    elif entry.name.endswith(self.dropfile_ext) and entry.path not in self.dropfiles:
+                        self.dropfiles[entry.path] = entry.stat().st_mtime
+                        self._touch(entry.path)
+                except OSError:
+                    continue
+
+    @staticmethod
+    def _size(path):
+        ''' total size of the files in a folder, None if it cannot be listed '''
+        size = 0
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return None
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    size += entry.stat().st_size
+            except OSError:
+                continue
+        return size
+
+    def _process_settled(self):
+        now = time.time()
+        settled = [path for path, changed in self.pending.items() if now - changed >= self.settle]
+        if not settled:
+            return
+
+        html_files = []
+        for path in settled:
+            del self.pending[path]
+            self.sizes.pop(path, None)
+            try:
+                uris = self._uris(path)
+            except OSError:
+                logger.exception('could not read {}'.format(path))
+                continue
+            for uri in uris:
+                logger.info('processing new uri: {}'.format(uri))
+                try:
+                    u = make_card(uri, registry=self.registry, index=self.index)
+                except Exception:
+                    logger.exception('could not generate a card for {}'.format(uri))
+                    continue
+                if u.html_file:
+                    html_files.append(u.html_file)
+
+        if self.registry:
+            self.registry.save()
+        if self.index is not None:
+            self.index.save()
+        if self.print_name and html_files:
+            try:
+                generate_pdf(filename=self.print_name, cards=html_files)
+            except Exception:
+                logger.exception('could not generate {}.pdf'.format(self.print_name))
+        profiler.report()
+
+    def _uris(self, path):
+        if path.endswith(self.dropfile_ext):
+            if not os.path.isfile(path):
+                return []
+            with open(path, 'r') as f:
+                return [line.strip() for line in f if 'spotify' in line]
+        elif os.path.isdir(path):
+            tracks = list_files(path, '.mp3') + list_files(path, '.flac')
+            if any(os.path.isfile(track) for track in tracks):
+                return [path]
+        return []
+
+class CardService:
+    '''
+    Long running card generation service (--serve), keeping the spotify session
+    and metadata, the tags read, the artwork index, the index and the registry
+    loaded between jobs
+    Jobs are posted as json to /jobs, e.g. {"type": "card", "uri": "spotify:album:...", "priority": 0}
+    or {"type": "print", "filename": "print"}; their status is at /jobs/<id>.
+    Jobs wait in a bounded priority queue (lowest priority number first) and
+    are handled by a pool of worker threads. A full queue answers 503.
+    Print jobs run on their own, waiting for running card jobs to finish.
+    Finished jobs are forgotten after keep seconds. The registry is saved whenever
+    the queue runs empty, the (much larger) index every save_interval seconds.
+    '''
+
+    def __init__(self, host='localhost', port=8765, workers=2, queue_size=1000, keep=3600,
+                 save_interval=60, registry=None, index=None):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.keep = keep
+        self.save_interval = save_interval
+        self.registry = registry
+        self.index = index
+        self.jobs = {}
+        self.finished = collections.deque()
+        self.queue = queue.PriorityQueue(maxsize=queue_size)
+        self.numbers = itertools.count(1)
+        self.lock = threading.Lock()
+        self.turns = threading.Condition()
+        self.making = 0
+        self.printing = False
+        self.print_waiting = 0
+        self.saving = threading.Lock()
+
+    def submit(self, job):
+        '''
+        queue a job, returns it with its id and status or None if the queue is full
+        raises ValueError for an invalid job
+        '''
+        if not isinstance(job, dict):
+            raise ValueError('a job should be a json object')
+        priority = job.get('priority', 0)
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            raise ValueError('priority should be an integer')
+        if job.get('type', 'card') not in ('card', 'print'):
+            raise ValueError('unknown job type {}'.format(job['type']))
+        if job.get('type', 'card') == 'card' and not isinstance(job.get('uri'), str):
+            raise ValueError('a card job needs an uri')
+        filename = job.get('filename', 'print')
+        if not isinstance(filename, str) or filename in ('', '.', '..') or os.path.basename(filename) != filename:
+            raise ValueError('filename should be a plain file name')
+
+        with self.lock:
+            number = next(self.numbers)
+        job = {'id': str(number), 'type': job.get('type', 'card'), 'status': 'queued',
+               'priority': priority, 'submitted': time.time(), 'request': job}
+        self.jobs[job['id']] = job
+        try:
+            self.queue.put_nowait((job['priority'], number, job['id']))
+        except queue.Full:
+            del self.jobs[job['id']]
+            return None
+        return job
+
+    def serve(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+        if self.index is not None:
+            threading.Thread(target=self._save_index_loop, daemon=True).start()
+
+        server = ThreadingHTTPServer((self.host, self.port), self._handler())
+        logger.info('serving on http://{}:{}/jobs with {} workers'.format(self.host, self.port, self.workers))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info('Stopping service...')
+        finally:
+            server.server_close()
+            if self.registry:
+                self.registry.save()
+            if self.index is not None:
+                self._save_index()
+
+    @contextmanager
+    def _turn(self, printing):
+        ''' card jobs run side by side, a print job runs alone '''
+        with self.turns:
+            if printing:
+                # a waiting print job holds off new card jobs, so it can't starve
+                self.print_waiting += 1
+                while self.printing or self.making:
+                    self.turns.wait()
+                self.print_waiting -= 1
+                self.printing = True
+            else:
+                while self.printing or self.print_waiting:
+                    self.turns.wait()
+                self.making += 1
+        try:
+            yield
+        finally:
+            with self.turns:
+                if printing:
+                    self.printing = False
+                else:
+                    self.making -= 1
+                self.turns.notify_all()
+
+    def _work(self):
+        while True:
+            priority, number, id = self.queue.get()
+            job = self.jobs[id]
+            job['status'] = 'running'
+            job['started'] = time.time()
+            request = job['request']
+            try:
+                if job['type'] == 'card':
+                    with self._turn(printing=False):
+                        u = make_card(request['uri'], registry=self.registry, title=request.get('title'))
+                    if u.is_processed and self.index is not None:
+                        with self.lock:
+                            self.index.add(u)
+                    job['card'] = u.html_file
+                    job['status'] = 'done' if u.html_file else 'failed'
+                else:
+                    with self._turn(printing=True):
+                        generate_pdf(filename=request.get('filename', 'print'))
+                    job['status'] = 'done'
+            except Exception as e:
+                logger.exception('job {} failed'.format(id))
+                job['status'] = 'failed'
+                job['error'] = str(e)
+            job['finished'] = time.time()
+            self._expire(job)
+
+            # save the registry whenever the queue runs empty, it is small and changes rarely
+            if self.queue.empty():
+                profiler.report()
+                if self.registry:
+                    self.registry.save()
+
+    def _save_index_loop(self):
+        while True:
+            time.sleep(self.save_interval)
+            try:
+                self._save_index()
+            except OSError:
+                logger.exception('could not save the index')
+
+    def _save_index(self):
+        ''' write the index if it changed, only the snapshot is taken under the lock '''
+        with self.saving:
+            with self.lock:
+                if not self.index.changed:
+                    return
+                snapshot = self.index.snapshot()
+            try:
+                self.index.save(snapshot)
+            except OSError:
+                with self.lock:
+                    self.index.changed = True
+                raise
+
+    def _expire(self, job):
+        with self.lock:
+            self.finished.append((job['finished'], job['id']))
+            while self.finished and self.finished[0][0] < job['finished'] - self.keep:
+                self.jobs.pop(self.finished.popleft()[1], None)
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                job = service.jobs.get(self.path[len('/jobs/'):]) if self.path.startswith('/jobs/') else None
+                if self.path.rstrip('/') == '/jobs':
+                    statuses = {}
+                    for job in list(service.jobs.values()):
+                        statuses[job['status']] = statuses.get(job['status'], 0) + 1
+                    self._reply(200, {'queued': service.queue.qsize(), 'jobs': statuses})
+                elif job:
+                    self._reply(200, {k: v for k, v in job.items() if k != 'request'})
+                else:
+                    self._reply(404, {'error': 'not found'})
+
+            def do_POST(self):
+                if self.path.rstrip('/') != '/jobs':
+                    self._reply(404, {'error': 'not found'})
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    job = service.submit(json.loads(self.rfile.read(length)))
+                except (TypeError, ValueError) as e:
+                    self._reply(400, {'error': str(e)})
+                    return
+                if job:
+                    self._reply(202, {'id': job['id'], 'status': job['status']})
+                else:
+                    self._reply(503, {'error': 'queue is full'})
+
+            def _reply(self, code, data):
+                body = json.dumps(data).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return Handler
+
 tests = {
     'library_mp3_track' : '/mnt/gijstereo/MP3/Ane Brun/Rarities/Ane Brun - 01. All My Tears.mp3',
     'library_flac_track': '/mnt/gijstereo/FLAC/Queen/A Night At The Opera/09 Love Of My Life.flac',
@@ -460,8 +1417,34 @@ def main(): #using argparser, the recommended module
     parser.add_argument('-p','--print', type=str, help='generate pdf with all html cards present in the output folder, provide output filename')
     parser.add_argument('-t','--tests', action='store_true', help='run tests (will ignore all other parameters)')
     parser.add_argument('-m','--move', action='store_true', help='move output folder')
+    parser.add_argument('-b','--browse', choices=['albums', 'tracks'], help='generate cards for all albums or tracks, browsing the library through the Volumio api')
+    parser.add_argument('--host', type=str, default='gijstereo.local', help='Volumio host to browse (default: gijstereo.local)')
+    parser.add_argument('--port', type=int, help='port of the Volumio host to browse (default: 80)')
+    parser.add_argument('-f','--find', type=str, help='search the index of processed music, e.g. "queen opera"')
+    parser.add_argument('--pick', type=str, help="with --find: generate cards for these hit numbers (e.g. '1,3') or 'all'")
+    parser.add_argument('--profile', action='store_true', help='time every stage of the run, report per card and in total in {}'.format(PROFILE_FILE))
+    parser.add_argument('--profile-dump', type=str, help='profile and write a cProfile dump per stage to this directory')
+    parser.add_argument('-w','--watch', type=str, help='keep watching this library root and generate cards for new albums and spotify *.uri files')
+    parser.add_argument('--settle', type=float, default=10, help='with --watch: seconds a folder should be unchanged before it is processed (default: 10)')
+    parser.add_argument('--poll', action='store_true', help='with --watch: compare folder mtimes instead of using inotify')
+    parser.add_argument('--watch-print', type=str, help='with --watch: generate a pdf with only the new cards, provide output filename')
+    parser.add_argument('--serve', type=int, metavar='PORT', help='run as a card generation service on this port, taking json jobs at /jobs')
+    parser.add_argument('--workers', type=int, default=2, help='with --serve: number of worker threads (default: 2)')
+    parser.add_argument('-s','--short', action='store_true', help='encode short ids in the qr codes, stored in {}'.format(REGISTRY_FILE))
     args = parser.parse_args()
 
+    registry = Registry() if args.short else None
+    if args.profile or args.profile_dump:
+        if args.serve and args.workers > 1:
+            parser.error('--profile measures the whole process, use it with --serve --workers 1')
+        profiler.enabled = True
+        profiler.dump_dir = args.profile_dump
+        if args.profile_dump and not os.path.exists(args.profile_dump):
+            os.makedirs(args.profile_dump)
+    # the index can be large, only load it for the options using it
+    uses_index = args.commands or args.uri or args.browse or args.find or args.pick or args.watch or args.serve
+    index = Index() if uses_index else None
+
     if args.tests:
         path_out = os.path.join(os.getcwd(), 'out')
         if os.path.exists(path_out):
@@ -484,21 +1467,56 @@ def main(): #using argparser, the recommended module
         else:
             logger.info('no output present, nothing to move')
 
-    if args.commands:
-        logger.info('processing commands...')
-        for cmd in cmds:
-            u = Uri(cmd)
-            u.process(title=cmds[cmd])
-            u.generate_card()
-
-    if args.uri:
-        logger.info('processing uri: {}'.format(args.uri))
-        u = Uri(args.uri)
-        u.process()
-        u.generate_card()
+    try:
+        if args.commands:
+            logger.info('processing commands...')
+            for cmd in cmds:
+                make_card(cmd, registry=registry, index=index, title=cmds[cmd])
+
+        if args.uri:
+            logger.info('processing uri: {}'.format(args.uri))
+            make_card(args.uri, registry=registry, index=index)
+
+        if args.browse:
+            logger.info('browsing {} on {}...'.format(args.browse, args.host))
+            library = VolumioLibrary(hostname=args.host, port=args.port)
+            try:
+                items = library.albums() if args.browse == 'albums' else library.tracks()
+                for item in items:
+                    try:
+                        make_card(item['uri'], registry=registry, index=index, item=item)
+                    except Exception:
+                        logger.exception('could not generate a card for {}'.format(item.get('uri')))
+            except IOError as e:
+                logger.error('browsing stopped, library incomplete: {}'.format(e))
+            finally:
+                library.disconnect()
+
+        if args.find:
+            find(index, args.find, pick=args.pick, registry=registry)
+    finally:
+        # cards made so far carry their short ids, so save even if the run fails
+        if registry:
+            registry.save()
+        if args.commands or args.uri or args.browse or args.pick:
+            index.save()
 
     if args.print:
         generate_pdf(filename=args.print)
 
+    # --watch and --serve report after every batch and on exit
+    profiler.report()
+
+    if args.watch:
+        watcher = Watcher(args.watch, settle=args.settle, registry=registry,
+                          index=index, print_name=args.watch_print, poll=args.poll)
+        watcher.run()
+        profiler.report()
+
+    if args.serve:
+        service = CardService(port=args.serve, workers=args.workers, registry=registry, index=index)
+        service.serve()
+        profiler.report()
+
 if __name__ == '__main__':
     main()
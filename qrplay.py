@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 
+import json
 import logging
 from logger import qrplayer_logger as logger
 import os
+import queue
 import subprocess
-from time import sleep
+import threading
+from time import sleep, time
 
 from socketIO_client import SocketIO
 
+REGISTRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'registry.json')
+
 
 def host_available(hostname):
     '''
@@ -21,11 +26,76 @@ def host_available(hostname):
     return not bool(ret_code)
 
 
+def process_start():
+    '''
+    Time the process was started by the kernel, so the startup timeline includes
+    interpreter and import time. Falls back to now where /proc is not available.
+    '''
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            # fields after the command name, starttime is field 22 of the stat line
+            started = int(f.read().rsplit(')', 1)[1].split()[19]) / os.sysconf('SC_CLK_TCK')
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        return time() - (uptime - started)
+    except (OSError, ValueError, IndexError):
+        return time()
+
+
+def load_registry(filename=REGISTRY_FILE):
+    '''
+    Load the short id registry generated by qren
+    Cards printed with 'qren.py --short' only carry an id like 'id:2f'
+    Returns an empty dict if no registry is present, full uri cards keep working
+    '''
+    if not os.path.exists(filename):
+        logger.info('no registry found at {}'.format(filename))
+        return {}
+    with open(filename, 'r') as f:
+        registry = json.load(f)
+    logger.info('loaded {} short ids from {}'.format(len(registry), filename))
+    return registry
+
+
+def registry_mtime(filename=REGISTRY_FILE):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+class Timeline:
+    '''
+    Keeps track of the startup milestones of the service, in seconds since process start
+    Each milestone is logged once, the whole timeline at the first confirmed play
+    '''
+
+    def __init__(self, start=None):
+        self.start = start or process_start()
+        self.events = [('process start', 0.0)]
+        self.lock = threading.Lock()
+
+    def mark(self, event):
+        with self.lock:
+            if event in dict(self.events):
+                return
+            elapsed = time() - self.start
+            self.events.append((event, elapsed))
+        logger.info('startup: {} after {:.1f} s'.format(event, elapsed))
+        if event == 'first confirmed play':
+            self.report()
+
+    def report(self):
+        logger.info('startup timeline: {}'.format(
+            ', '.join('{} {:.1f} s'.format(event, t) for event, t in self.events)))
+
+
 class VolumioControler:
 
     def __init__(self, hostname='gijstereo.local', logger=None): #'192.168.178.59'):
 
         self.playload = None
+        self.connected = False
 
         if not logger:
             logger = logging.getLogger()
@@ -52,13 +122,13 @@ class VolumioControler:
                 self.sio = sio
                 self.state()
             else:
-                logger.error('failed to connect to {}'.format(server))
+                logger.error('failed to connect to {}'.format(hostname))
         else:
             logger.error('failed to start, host {} was not found alive'.format(hostname))
 
 
     def _on_re_state(self,data):
-        self.playload = {k: data[k] for k in data.keys() & {'service', 'title', 'uri'}}
+        self.playload = {k: data[k] for k in data.keys() & {'service', 'status', 'title', 'uri'}}
 
     def _on_re_browse(self, data):
         logger.info('received browsing results')
@@ -68,13 +138,22 @@ class VolumioControler:
         self.sio.wait(seconds=1)
 
     def playsong(self, uri):
+        '''
+        Returns True once Volumio reports the play. Album and playlist uris are
+        replaced by the uri of their first track in the state, so a new uri
+        that is playing counts as well.
+        '''
+        before = self.playload or {}
         self.sio.emit('addPlay',{'uri': uri})
         self.sio.wait(seconds=1)
         self.state()
-        if self.playload['uri'] == uri:
+        after = self.playload or {}
+        if after.get('uri') == uri or (after.get('status') == 'play' and after.get('uri') != before.get('uri')):
             logger.debug('successfully started playing {}'.format(uri))
+            return True
         else:
             logger.error('failed to start playing {}'.format(uri))
+            return False
 
     def toggle(self):
         self.sio.emit('toggle','')
@@ -107,9 +186,47 @@ class Scanner():
         self.scan = None
         if not logger:
             logger = Logger('SCANNER')
-        self.stereo = VolumioControler(hostname=hostname, logger=logger)
+        self.logger = logger
+        self.hostname = hostname
+        self.stereo = None
         self.qrcode = ''
-
+        self.registry_mtime = registry_mtime()
+        self.registry = load_registry()
+        self.timeline = Timeline()
+        # cards scanned before the connection is up wait in the queue
+        self.scanned = queue.Queue()
+        self.ready = threading.Event()
+
+    def _connect(self):
+        ''' keep trying to connect to the Volumio host, runs next to the scanner '''
+        while not self.ready.is_set():
+            stereo = VolumioControler(hostname=self.hostname, logger=self.logger)
+            if stereo.connected:
+                self.stereo = stereo
+                self.timeline.mark('socket connected')
+                if not self.scanned.empty():
+                    logger.info('handling {} cards scanned while connecting'.format(self.scanned.qsize()))
+                self.ready.set()
+
+    def _dispatch(self):
+        self.ready.wait()
+        while True:
+            code = self.scanned.get()
+            try:
+                self._handlecmd(self._resolve(code))
+            except Exception:
+                logger.exception('failed to handle {}'.format(code))
+
+    def _resolve(self, code):
+        if code.startswith('id:'):
+            # cards made after startup (qren --watch or --serve) need a fresh registry
+            if code not in self.registry and registry_mtime() != self.registry_mtime:
+                self.registry_mtime = registry_mtime()
+                self.registry = load_registry()
+            if code in self.registry:
+                return self.registry[code]
+            logger.error('short id {} not found in registry'.format(code))
+        return code
 
     def _handlecmd(self, cmd):
         if cmd.startswith('cmd:'):
@@ -130,12 +247,19 @@ class Scanner():
             else:
                 logger.error("command '{}' not understood".format(cmd))
         elif cmd.startswith('spotify:'):
-            self.stereo.playsong(cmd)
+            self._play(cmd)
         elif cmd.startswith('lib:'):
-            self.stereo.playsong(cmd)
+            self._play(cmd)
+        elif cmd.startswith('vol:'):
+            # cards generated with 'qren.py --browse' carry Volumio's own uri
+            self._play(cmd[len('vol:'):])
         else:
             logger.error("don't know what to do with command '{}'".format(cmd))
 
+    def _play(self, uri):
+        if self.stereo.playsong(uri):
+            self.timeline.mark('first confirmed play')
+
     def _scan(self):
 
         while True:
@@ -143,20 +267,29 @@ class Scanner():
             qrcode = str(data)[8:]
             if qrcode:
                 self.qrcode = qrcode.rstrip()
-                logger.info('scanned {}'.format(self.qrcode))
-                self._handlecmd(self.qrcode)
+                self.timeline.mark('first scan')
+                if self.ready.is_set():
+                    logger.info('scanned {}'.format(self.qrcode))
+                else:
+                    logger.info('scanned {}, queued until connected'.format(self.qrcode))
+                self.scanned.put(self.qrcode)
 
     def startscanner(self):
+        # the camera starts right away, connecting to the host can take 30+ seconds at boot
+        threading.Thread(target=self._connect, daemon=True).start()
+        threading.Thread(target=self._dispatch, daemon=True).start()
         self.cam = os.popen('/usr/bin/zbarcam --nodisplay --prescale=300x250', 'r')
+        self.timeline.mark('zbarcam launched')
         try:
             self._scan()
         except KeyboardInterrupt:
             logger.info('Stopping scanner...')
         finally:
-            self.stereo.disconnect()
-            if not self.stereo.connected:
-                logger.info('disconnected from server')
-                logger.info('------------------------')
+            if self.stereo:
+                self.stereo.disconnect()
+                if not self.stereo.connected:
+                    logger.info('disconnected from server')
+                    logger.info('------------------------')
             self.cam.close()
 
 if __name__ == '__main__':
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+'''
+Local stand-in for Volumio's browse api, to try 'qren.py --browse' without the stereo
+Serves a small generated library over socket.io, answering browseLibrary
+with pushBrowseLibrary the way Volumio does. The artist list is paged
+with a 'next' uri to exercise pagination.
+Needs python-socketio 4 (pip install "python-socketio<5"), which still speaks
+the protocol version of socketIO_client.
+
+    python3 volumio_standin.py --port 3000
+    python3 qren.py --browse albums --host localhost --port 3000
+'''
+import argparse
+import logging
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+
+import socketio
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+sh = logging.StreamHandler()
+sh.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)-8s: %(message)s'))
+logger.addHandler(sh)
+
+
+def library(artists=3, albums=2, tracks=3):
+    ''' generate a library as {artist: {album: [track titles]}} '''
+    return {'Artist {}'.format(a): {'Album {}'.format(b): ['Track {}'.format(t) for t in range(1, tracks + 1)]
+                                    for b in range(1, albums + 1)}
+            for a in range(1, artists + 1)}
+
+
+def browse(music, uri, page_size=2):
+    ''' the navigation Volumio would answer for uri '''
+    if uri.startswith('artists://') and uri[len('artists://'):].split('?')[0] == '':
+        page = int(uri.split('page=')[1]) if 'page=' in uri else 0
+        names = sorted(music)[page * page_size:(page + 1) * page_size]
+        items = [{'type': 'folder', 'title': name, 'uri': 'artists://{}'.format(name)} for name in names]
+        navigation = {'lists': [{'items': items}], 'prev': {'uri': '/'}}
+        if (page + 1) * page_size < len(music):
+            navigation['next'] = {'uri': 'artists://?page={}'.format(page + 1)}
+        return {'navigation': navigation}
+    elif uri.startswith('artists://'):
+        artist = uri[len('artists://'):]
+        items = [{'type': 'folder', 'title': album, 'artist': artist,
+                  'uri': 'albums://{}/{}'.format(artist, album),
+                  'albumart': '/albumart?web={}/{}/large'.format(artist, album)}
+                 for album in sorted(music.get(artist, {}))]
+        return {'navigation': {'lists': [{'items': items}], 'prev': {'uri': 'artists://'}}}
+    elif uri.startswith('albums://'):
+        artist, album = uri[len('albums://'):].split('/', 1)
+        items = [{'type': 'song', 'title': title, 'artist': artist, 'album': album,
+                  'uri': 'music-library/USB/FLAC/{}/{}/{}.flac'.format(artist, album, title),
+                  'albumart': '/albumart?web={}/{}/large'.format(artist, album)}
+                 for title in music.get(artist, {}).get(album, [])]
+        return {'navigation': {'lists': [{'items': items}], 'prev': {'uri': 'artists://{}'.format(artist)}}}
+    return {'navigation': {'lists': []}}
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=3000, music=None):
+    music = music or library()
+    sio = socketio.Server(async_mode='threading')
+
+    @sio.on('browseLibrary')
+    def on_browse(sid, data):
+        logger.debug('browse {}'.format(data.get('uri')))
+        sio.emit('pushBrowseLibrary', browse(music, data.get('uri', '')), room=sid)
+
+    server = make_server('localhost', port, socketio.WSGIApp(sio),
+                         server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    logger.info('volumio stand-in serving {} artists on port {}'.format(len(music), port))
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in for the Volumio browse api')
+    parser.add_argument('--port', type=int, default=3000, help='port to serve on (default: 3000)')
+    parser.add_argument('--artists', type=int, default=3, help='number of artists in the library (default: 3)')
+    args = parser.parse_args()
+
+    server = serve(port=args.port, music=library(artists=args.artists))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Stopping stand-in...')
+
+
+if __name__ == '__main__':
+    main()